@@ -7,6 +7,7 @@ import os
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache, wraps
 
 import boto3
@@ -81,7 +82,7 @@ def create_logconfig(logtype):
     type_int = ['max_log_count', 'text_header_line_number',
                 'ignore_header_line_number']
     type_bool = ['via_cwl', 'via_firelens', 'ignore_container_stderr',
-                 'timestamp_nano']
+                 'timestamp_nano', 'use_re2', 'json_raw_message']
     type_list = ['base.tags', 'container.image.tag', 'dns.answers',
                  'dns.header_flags', 'dns.resolved_ip', 'dns.type',
                  'event.category', 'event.type', 'file.attributes',
@@ -122,6 +123,12 @@ def create_logconfig(logtype):
             logconfig[key] = get_value_from_etl_config(logtype, key)
     if logconfig['file_format'] in ('xml', ):
         logconfig['multiline_firstline'] = logconfig['xml_firstline']
+    if logconfig['doc_id_hash'] not in siem.DOC_ID_HASHES:
+        logger.warning(
+            f'doc_id_hash = {logconfig["doc_id_hash"]} of {logtype} is not '
+            f'available. md5 is used instead. available values are '
+            f'{", ".join(siem.DOC_ID_HASHES)}')
+        logconfig['doc_id_hash'] = 'md5'
     return logconfig
 
 
@@ -174,38 +181,42 @@ def check_es_results(results, total_count):
 def bulkloads_into_elasticsearch(es_entries, collected_metrics):
     output_size, total_output_size = 0, 0
     total_count, success_count, error_count, es_response_time = 0, 0, 0, 0
-    results = False
     putdata_list = []
+    bulk_jobs = []
     error_reason_list = []
     filter_path = ['took', 'errors', 'items.index.status',
                    'items.index.error.reason', 'items.index.error.type']
-    for data in es_entries:
-        putdata_list.append(data)
-        output_size += len(str(data))
-        # es の http.max_content_length は t2 で10MB なのでデータがたまったらESにロード
-        if isinstance(data, str) and output_size > 6000000:
+    # ESへのロードは別スレッドで実行し、その間に次のデータをパースする
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for data in es_entries:
+            putdata_list.append(data)
+            output_size += len(str(data))
+            # es の http.max_content_length は t2 で10MB なのでデータがたまったらESにロード
+            if isinstance(data, str) and output_size > 6000000:
+                if bulk_jobs:
+                    # 同時にロードするのは1つだけ
+                    bulk_jobs[-1][0].result()
+                total_output_size += output_size
+                future = executor.submit(
+                    es_conn.bulk, putdata_list, filter_path=filter_path)
+                bulk_jobs.append((future, total_count))
+                output_size = 0
+                total_count += len(putdata_list)
+                putdata_list = []
+        if output_size > 0:
             total_output_size += output_size
-            results = es_conn.bulk(putdata_list, filter_path=filter_path)
-            es_took, success, error, error_reasons = check_es_results(
-                results, total_count)
-            success_count += success
-            error_count += error
-            es_response_time += es_took
-            output_size = 0
+            future = executor.submit(
+                es_conn.bulk, putdata_list, filter_path=filter_path)
+            bulk_jobs.append((future, total_count))
             total_count += len(putdata_list)
-            putdata_list = []
-            if len(error_reasons):
-                error_reason_list.extend([error_reasons])
-    if output_size > 0:
-        total_output_size += output_size
-        results = es_conn.bulk(putdata_list, filter_path=filter_path)
+    for future, start_count in bulk_jobs:
+        results = future.result()
         # logger.debug(results)
         es_took, success, error, error_reasons = check_es_results(
-            results, total_count)
+            results, start_count)
         success_count += success
         error_count += error
         es_response_time += es_took
-        total_count += len(putdata_list)
         if len(error_reasons):
             error_reason_list.extend([error_reasons])
     collected_metrics['total_output_size'] = total_output_size
@@ -9,18 +9,68 @@ import json
 import re
 import urllib.parse
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from functools import cached_property, wraps
+from itertools import chain, islice
 
-import xmltodict
 from aws_lambda_powertools import Logger
 
 from siem import utils, winevtxml
 
+try:
+    # optional. なければ json でシリアライズする
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # optional. なければ gzip モジュールで展開する
+    from isal import igzip
+except ImportError:
+    igzip = gzip
+try:
+    # optional. doc_id_hash = xxh128 で使う
+    import xxhash
+except ImportError:
+    xxhash = None
+
 __version__ = '2.5.0'
 
 logger = Logger(child=True)
 
+# S3 からの読み込みバッファ。展開処理からの細かい read をまとめる
+S3_READ_BUFFER_SIZE = 4 * 1024 * 1024
+# 分割したログのメタデータを SQS に送る並列数
+SQS_SEND_MAX_WORKERS = 16
+# del_none で削除する値のないフィールドの文字列
+EMPTY_STR_VALUES = frozenset(('', '-', 'null', '[]'))
+# doc_id_hash で選択できる @id のハッシュ関数
+DOC_ID_HASHES = {'md5': hashlib.md5}
+if xxhash is not None:
+    DOC_ID_HASHES['xxh128'] = xxhash.xxh128
+# multiline の先頭行を探索する正規表現の組み立て用
+RE_LEADING_INLINE_FLAGS = re.compile(r'^\(\?[aiLmsux]+\)')
+RE_ANCHOR_OF_STRING = re.compile(r'\\[AZ]')
+RE_NEWLINE = re.compile('\n')
+
+
+class StreamingBodyIO(io.RawIOBase):
+    """botocore の StreamingBody を io.BufferedReader で読むための adapter.
+
+    StreamingBody.read を使うので content-length の検証は維持される
+    """
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.body.read(len(b))
+        size = len(data)
+        b[:size] = data
+        return size
+
 
 class LogS3:
     """取得した一連のログファイルから表層的な情報を取得し、個々のログを返す.
@@ -50,6 +100,8 @@ class LogS3:
         self.__rawdata = self.extract_rawdata_from_s3obj()
         if self.file_format in ('multiline', 'xml', 'winevtxml', ):
             self.re_multiline_firstline = self.logconfig['multiline_firstline']
+            self.re_multiline_firstline_scan = self.compile_multiline_scan(
+                self.re_multiline_firstline)
 
     def __iter__(self):
         if self.is_ignored:
@@ -72,23 +124,8 @@ class LogS3:
         @wraps(func)
         def _wrapper(inst, *args, **kargs):
             if inst.via_cwl:
-                index: int = 0
-                line_num: int = 0
-                decoder = json.JSONDecoder()
-                body = inst.__rawdata
-                while True:
-                    try:
-                        obj, offset = decoder.raw_decode(body.read())
-                    except json.decoder.JSONDecodeError:
-                        break
-                    index = offset + index
-                    body.seek(index)
-                    if (isinstance(obj, dict)
-                            and 'logEvents' in obj
-                            and obj['messageType'] == 'DATA_MESSAGE'):
-                        for logevent in obj['logEvents']:
-                            line_num += 1
-                return(line_num)
+                return sum(len(obj['logEvents'])
+                           for obj in inst.iter_cwl_data_message())
             else:
                 return func(inst, *args, **kargs)
         return _wrapper
@@ -119,8 +156,7 @@ class LogS3:
     def log_count(self):
         if self.end_number == 0:
             if self.file_format in ('text', 'csv') or self.via_firelens:
-                log_count = len(self.rawdata.readlines())
-                # log_count = sum(1 for line in self.rawdata)
+                log_count = utils.count_lines(self.__rawdata)
             elif self.file_format in ('json', ):
                 log_count = self.count_logobj_in_json()
             elif self.file_format in ('winevtxml', ):
@@ -139,13 +175,14 @@ class LogS3:
 
     @property
     def rawdata(self):
-        self.__rawdata.seek(0)
-        return self.__rawdata
+        # 展開済みのデータを共有する新しいストリームを返すので seek は不要
+        return io.TextIOWrapper(
+            io.BytesIO(self.__rawdata), encoding='utf8', errors='ignore')
 
     @cached_property
     def csv_header(self):
         if 'csv' in self.file_format:
-            return self.rawdata.readlines()[0].strip()
+            return self.rawdata.readline().strip()
         else:
             return None
 
@@ -199,7 +236,7 @@ class LogS3:
         elif self.via_firelens:
             yield from self.extract_firelens_log(start, end)
         elif self.file_format in ('text', 'csv'):
-            for logdata in self.rawdata.readlines()[start:end]:
+            for logdata in islice(self.rawdata, start, end):
                 yield (logdata.strip(), logmeta)
         elif self.file_format in ('json', ):
             logobjs = self.extract_logobj_from_json(start, end)
@@ -234,40 +271,44 @@ class LogS3:
             end = self.end_number
         return start, end
 
-    def extract_cwl_log(self, start, end):
-        index: int = 0
-        line_num: int = 0
+    def iter_cwl_data_message(self):
+        # CWL の subscription filter 経由のデータは json が連結されている
+        text = self.rawdata.read()
         decoder = json.JSONDecoder()
-        self.__rawdata.seek(0)
-        body = self.__rawdata
+        index = 0
         while True:
             try:
-                obj, offset = decoder.raw_decode(body.read())
+                obj, index = decoder.raw_decode(text, index)
             except json.decoder.JSONDecodeError:
                 break
-            index = offset + index
-            body.seek(index)
             if (isinstance(obj, dict)
                     and 'logEvents' in obj
                     and obj['messageType'] == 'DATA_MESSAGE'):
-                logmeta = {'cwl_accountid': obj['owner'],
-                           'loggroup': obj['logGroup'],
-                           'logstream': obj['logStream']}
-                for logevent in obj['logEvents']:
-                    if start <= line_num < end:
-                        logmeta['cwl_id'] = logevent['id']
-                        logmeta['cwl_timestamp'] = logevent['timestamp']
-                        if self.file_format in ('json', ):
-                            yield json.loads(logevent['message']), logmeta
-                        else:
-                            yield logevent['message'], logmeta
-                    line_num += 1
+                yield obj
+
+    def extract_cwl_log(self, start, end):
+        line_num: int = 0
+        for obj in self.iter_cwl_data_message():
+            logmeta = {'cwl_accountid': obj['owner'],
+                       'loggroup': obj['logGroup'],
+                       'logstream': obj['logStream']}
+            for logevent in obj['logEvents']:
+                if start <= line_num < end:
+                    logmeta['cwl_id'] = logevent['id']
+                    logmeta['cwl_timestamp'] = logevent['timestamp']
+                    if self.file_format == 'json':
+                        logmeta['__raw_message'] = logevent['message']
+                        yield (utils.loads_json(logevent['message']),
+                               logmeta)
+                    else:
+                        yield logevent['message'], logmeta
+                line_num += 1
 
     def extract_firelens_log(self, start, end):
         ignore_container_stderr_bool = (
             self.logconfig['ignore_container_stderr'])
-        for logdata in self.rawdata.readlines()[start:end]:
-            obj = json.loads(logdata.strip())
+        for logdata in islice(self.rawdata, start, end):
+            obj = utils.loads_json(logdata)
             firelens_meta_dict = {}
             # basic firelens field
             firelens_meta_dict['container_id'] = obj.get('container_id')
@@ -291,15 +332,17 @@ class LogS3:
                 else:
                     firelens_meta_dict['__skip_normalization'] = True
                     firelens_meta_dict['__error_message'] = logdata
-            if self.file_format in ('json', ):
+            if self.file_format == 'json':
                 try:
-                    logdata = json.loads(logdata)
+                    logdata = utils.loads_json(logdata)
                 except json.decoder.JSONDecodeError:
                     error_message = 'Invalid file format found during parsing'
                     firelens_meta_dict['__skip_normalization'] = True
                     if '__error_message' in firelens_meta_dict:
                         firelens_meta_dict['__error_message'] = error_message
                     logger.warn(f'{error_message} {self.s3key}')
+                else:
+                    firelens_meta_dict['__raw_message'] = obj['log']
             yield (logdata, firelens_meta_dict)
 
     def extract_rawdata_from_s3obj(self):
@@ -321,112 +364,133 @@ class LogS3:
             self.ignored_reason = (f'no valid contents in s3 object, size of '
                                    f'{self.s3key} is only {s3size} byte')
             return None
-        rawbody = io.BytesIO(obj['Body'].read())
-        mime_type = utils.get_mime_type(rawbody.read(16))
-        rawbody.seek(0)
+        # S3 の StreamingBody を直接展開して、圧縮データ全体をメモリに載せない
+        rawbody = io.BufferedReader(
+            StreamingBodyIO(obj['Body']), buffer_size=S3_READ_BUFFER_SIZE)
+        mime_type = utils.get_mime_type(rawbody.peek(16)[:16])
         if mime_type == 'gzip':
-            body = gzip.open(rawbody, mode='rt', encoding='utf8',
-                             errors='ignore')
+            # ISA-L による展開。gzip モジュールと互換
+            rawdata = igzip.GzipFile(fileobj=rawbody, mode='rb').read()
         elif mime_type == 'text':
-            body = io.TextIOWrapper(rawbody, encoding='utf8', errors='ignore')
+            rawdata = rawbody.read()
         elif mime_type == 'zip':
-            z = zipfile.ZipFile(rawbody)
-            body = open(z.namelist()[0], encoding='utf8', errors='ignore')
+            # zip needs seekable file object
+            z = zipfile.ZipFile(io.BytesIO(rawbody.read()))
+            rawdata = z.read(z.namelist()[0])
         elif mime_type == 'bzip2':
-            body = bz2.open(rawbody, mode='rt', encoding='utf8',
-                            errors='ignore')
+            rawdata = bz2.BZ2File(rawbody, mode='rb').read()
         else:
             logger.error('unknown file format')
             raise Exception('unknown file format')
-        return body
+        # 展開済みのデータは bytes のまま保持して、読む度にストリームを作る
+        return rawdata
 
-    def count_logobj_in_json(self):
+    def decode_json_line(self, line):
+        # yield json object and its original text
+        try:
+            # ndjson. most lines have just one json object
+            raw_event = utils.loads_json(line)
+        except json.decoder.JSONDecodeError:
+            pass
+        else:
+            yield raw_event, line
+            return
+        # for Firehose's json (multiple jsons in 1 line)
         decoder = json.JSONDecoder()
+        size = len(line)
+        index = 0
+        while index < size:
+            raw_event, offset = decoder.raw_decode(line, index)
+            yield raw_event, line[index:offset]
+            search = json.decoder.WHITESPACE.search(line, offset)
+            if search is None:
+                break
+            index = search.end()
+
+    def iter_logobj_in_json(self, need_meta=False):
         delimiter = self.logconfig['json_delimiter']
-        count = 0
         # For ndjson
-        for line in self.rawdata.readlines():
-            # for Firehose's json (multiple jsons in 1 line)
-            size = len(line)
-            index = 0
-            while index < size:
-                raw_event, offset = decoder.raw_decode(line, index)
-                raw_event, logmeta = self.check_cwe_and_strip_header(raw_event)
-                if delimiter and (delimiter in raw_event):
+        for line in self.rawdata:
+            for raw_event, raw_message in self.decode_json_line(line):
+                record, logmeta = self.check_cwe_and_strip_header(
+                    raw_event, need_meta=need_meta)
+                if delimiter and (delimiter in record):
                     # multiple evets in 1 json
-                    for record in raw_event[delimiter]:
-                        count += 1
+                    for record in record[delimiter]:
+                        yield (record, logmeta)
                 elif not delimiter:
-                    count += 1
-                search = json.decoder.WHITESPACE.search(line, offset)
-                if search is None:
-                    break
-                index = search.end()
-        return count
+                    if need_meta and record is raw_event:
+                        # @message に元のテキストをそのまま使う
+                        logmeta['__raw_message'] = raw_message.strip()
+                    yield (record, logmeta)
+
+    def count_logobj_in_json(self):
+        return sum(1 for _ in self.iter_logobj_in_json())
 
     def extract_logobj_from_json(self, start=0, end=0):
-        decoder = json.JSONDecoder()
-        delimiter = self.logconfig['json_delimiter']
-        count = 0
-        # For ndjson
-        for line in self.rawdata.readlines():
-            # for Firehose's json (multiple jsons in 1 line)
-            size = len(line)
-            index = 0
-            while index < size:
-                raw_event, offset = decoder.raw_decode(line, index)
-                raw_event, logmeta = self.check_cwe_and_strip_header(
-                    raw_event, need_meta=True)
-                if delimiter and (delimiter in raw_event):
-                    # multiple evets in 1 json
-                    for record in raw_event[delimiter]:
-                        count += 1
-                        if start <= count <= end:
-                            yield (record, logmeta)
-                elif not delimiter:
-                    count += 1
-                    if start <= count <= end:
-                        yield (raw_event, logmeta)
-                search = json.decoder.WHITESPACE.search(line, offset)
-                if search is None:
-                    break
-                index = search.end()
-
-    def match_multiline_firstline(self, line):
-        if self.re_multiline_firstline.match(line):
-            return True
+        logobjs = self.iter_logobj_in_json(need_meta=True)
+        for count, (record, logmeta) in enumerate(logobjs, 1):
+            if count > end:
+                # no need to parse the rest of file
+                return
+            if start <= count:
+                yield (record, logmeta)
+
+    @staticmethod
+    def compile_multiline_scan(re_firstline):
+        # 行単位ではなくファイル全体を1回の走査で候補行を探す用。
+        # 先頭が \n のリテラルなので改行位置だけを高速に探索できる。
+        # 先頭の (?i) などは flags で渡し、\A, \Z は行単位の走査にする
+        if not re_firstline:
+            return None
+        pattern = re_firstline.pattern
+        if RE_ANCHOR_OF_STRING.search(pattern):
+            return None
+        pattern = RE_LEADING_INLINE_FLAGS.sub('', pattern)
+        try:
+            return re.compile(
+                '\n(?=' + pattern + ')', re_firstline.flags | re.MULTILINE)
+        except re.error:
+            logger.info(f'{re_firstline.pattern} is scanned line by line')
+            return None
+
+    def iter_multiline_log_offset(self, text):
+        # 各ログの先頭行の開始位置
+        size = len(text)
+        if self.re_multiline_firstline_scan:
+            candidates = (m.end() for m in
+                          self.re_multiline_firstline_scan.finditer(text))
         else:
-            return False
+            candidates = (m.end() for m in RE_NEWLINE.finditer(text))
+        for offset in chain((0, ), candidates):
+            if offset >= size:
+                # the end of text is not a line
+                break
+            # \s や [^...] が改行を越えて一致しないように1行ずつ確認する
+            endpos = text.find('\n', offset) + 1 or size
+            if self.re_multiline_firstline.match(text[offset:endpos]):
+                yield offset
 
     def count_multiline_log(self):
-        count = 0
-        for line in self.rawdata:
-            if self.match_multiline_firstline(line):
-                count += 1
-        return count
+        text = self.rawdata.read()
+        return sum(1 for _ in self.iter_multiline_log_offset(text))
 
     def extract_multiline_log(self, start=0, end=0):
-        count = 0
         metadata = {}
-        multilog = []
-        is_in_scope = False
-        for line in self.rawdata:
-            if self.match_multiline_firstline(line):
-                count += 1
-                if start < count <= end:
-                    if len(multilog) > 0:
-                        # yield previous log
-                        yield("".join(multilog).rstrip(), metadata)
-                    multilog = []
-                    is_in_scope = True
-                    multilog.append(line)
-                else:
-                    continue
-            elif is_in_scope:
-                multilog.append(line)
-        if is_in_scope:
+        text = self.rawdata.read()
+        # 次のログの開始位置までを1つのログとして切り出す
+        offsets = islice(self.iter_multiline_log_offset(text), start, end + 1)
+        head = next(offsets, None)
+        if head is None:
+            return
+        count = start
+        for tail in offsets:
+            yield (text[head:tail].rstrip(), metadata)
+            count += 1
+            head = tail
+        if count < end:
             # yield last log
-            yield("".join(multilog).rstrip(), metadata)
+            yield (text[head:].rstrip(), metadata)
 
     def check_cwe_and_strip_header(self, dict_obj, need_meta=False):
         logmeta = {}
@@ -463,6 +527,7 @@ class LogS3:
         logger.debug({'split_logs': f's3://{self.s3bucket}/{self.s3key}',
                       'max_log_count': self.max_log_count,
                       'log_count': self.log_count})
+        entries_list = []
         entries = []
         last_num = len(metadata)
         for i, (start, end) in enumerate(metadata):
@@ -473,11 +538,22 @@ class LogS3:
             message_body = json.dumps(queue_body)
             entries.append({'Id': f'num_{start}', 'MessageBody': message_body})
             if (len(entries) == 10) or (i == last_num - 1):
-                response = self.sqs_queue.send_messages(Entries=entries)
+                entries_list.append(entries)
+                entries = []
+
+        # boto3 の resource はスレッドセーフではないので client で並列に送る
+        sqs_client = self.sqs_queue.meta.client
+        queue_url = self.sqs_queue.url
+
+        def send_message_batch(entries):
+            return sqs_client.send_message_batch(
+                QueueUrl=queue_url, Entries=entries)
+
+        with ThreadPoolExecutor(max_workers=SQS_SEND_MAX_WORKERS) as executor:
+            for response in executor.map(send_message_batch, entries_list):
                 if response['ResponseMetadata']['HTTPStatusCode'] != 200:
                     logger.error(json.dumps(response))
                     raise Exception(json.dumps(response))
-                entries = []
         return last_num
 
 
@@ -488,6 +564,25 @@ class LogParser:
     テキストなら名前付き正規化による抽出、エンリッチ(geoipなどの付与)、
     フィールドのECSへの統一、最後にJSON化、する
     """
+    # ログ毎に属性を読み書きするので __dict__ を持たせない。
+    # 属性を追加したらここにも追加する。__ で始まる属性は _LogParser__ を付ける
+    __slots__ = (
+        'logfile', 'logconfig', 'sf_module', 'geodb_instance',
+        'exclude_log_patterns', 'flat_exclude_patterns',
+        'logtype', 's3key', 's3key_bytes', 's3bucket', 'logformat', 'header',
+        'csv_field_count', 'csv_safe_fields',
+        'accountid', 'region', 'loggroup', 'logstream', 'via_firelens',
+        'timestamp_tz', 'index_tz', 'has_nanotime',
+        're_log_pattern', 'timestamp_key', 'timestamp_format',
+        'doc_id_key', 'doc_id_suffix_keypath', 'doc_id_hash',
+        'json_raw_message', 'geoip_list',
+        'static_ecs_items', 'ecs_keypaths', 'multifield_keypaths',
+        'logdata', 'logmeta', 'cwl_id', 'cwl_timestamp', 'cwe_id',
+        'cwe_timestamp', 'ignored_reason',
+        '_LogParser__logdata_dict', '_LogParser__event_ingested',
+        '_LogParser__skip_normalization', '_LogParser__timestamp',
+    )
+
     def __init__(self, logfile, logconfig, sf_module, geodb_instance,
                  exclude_log_patterns):
         self.logfile = logfile
@@ -495,12 +590,25 @@ class LogParser:
         self.sf_module = sf_module
         self.geodb_instance = geodb_instance
         self.exclude_log_patterns = exclude_log_patterns
+        # 除外パターンはファイル毎に1回だけフラット化する
+        self.flat_exclude_patterns = utils.flatten_exclude_patterns(
+            exclude_log_patterns.get(logfile.logtype))
 
         self.logtype = logfile.logtype
         self.s3key = logfile.s3key
+        # @id のハッシュ計算用
+        self.s3key_bytes = self.s3key.encode('utf-8')
         self.s3bucket = logfile.s3bucket
         self.logformat = logfile.file_format
         self.header = logfile.csv_header
+        if self.header:
+            # ヘッダーのフィールド名の変換はファイル毎に1回だけ行う。
+            # 変換後のフィールド名とその値の位置の組み合わせ
+            header_fields = self.header.split()
+            self.csv_field_count = len(header_fields)
+            self.csv_safe_fields = tuple(
+                utils.convert_keyname_to_safe_field(
+                    {key: i for i, key in enumerate(header_fields)}).items())
         self.accountid = logfile.accountid
         self.region = logfile.region
         self.loggroup = None
@@ -513,6 +621,42 @@ class LogParser:
             self.index_tz = timezone(
                 timedelta(hours=float(self.logconfig['index_tz'])))
         self.has_nanotime = self.logconfig['timestamp_nano']
+        # ログ毎に参照する設定値は、ファイル毎に1回だけ取り出しておく
+        self.re_log_pattern = self.logconfig.get('log_pattern')
+        if self.logconfig['use_re2']:
+            self.re_log_pattern = utils.compile_log_pattern_with_re2(
+                self.re_log_pattern)
+        self.timestamp_key = self.logconfig['timestamp_key']
+        self.timestamp_format = self.logconfig['timestamp_format']
+        self.doc_id_key = self.logconfig['doc_id']
+        if self.logconfig['doc_id_suffix']:
+            self.doc_id_suffix_keypath = utils.compile_dotted_key(
+                self.logconfig['doc_id_suffix'])
+        else:
+            self.doc_id_suffix_keypath = None
+        self.doc_id_hash = DOC_ID_HASHES[self.logconfig['doc_id_hash']]
+        self.json_raw_message = self.logconfig['json_raw_message']
+        self.geoip_list = self.logconfig['geoip'].split()
+        # static_ecs はログに依存しないので、キーと値の組をここで作っておく。
+        # dict はログ毎に変更されるので、テンプレートを共有せずに毎回代入する
+        self.static_ecs_items = tuple(
+            (static_ecs_key, self.logconfig[static_ecs_key])
+            for static_ecs_key in self.logconfig['static_ecs'].split())
+
+        # 値を取得する元フィールドの dotted key はファイル毎に1回だけ分解する
+        self.ecs_keypaths = []
+        for ecs_key in self.logconfig['ecs'].split():
+            original_keys = self.logconfig[ecs_key]
+            if isinstance(original_keys, str):
+                keypaths = utils.compile_dotted_keylist(original_keys)
+                self.ecs_keypaths.append((ecs_key, keypaths, False))
+            elif isinstance(original_keys, list):
+                keypaths = tuple(utils.compile_dotted_keylist(key_list)
+                                 for key_list in original_keys)
+                self.ecs_keypaths.append((ecs_key, keypaths, True))
+        self.multifield_keypaths = [
+            (multifield_key, utils.compile_dotted_key(multifield_key))
+            for multifield_key in self.logconfig['json_to_text'].split()]
 
     def __call__(self, logdata, logmeta):
         self.logdata = logdata
@@ -531,6 +675,7 @@ class LogParser:
         if logmeta.get('container_name'):
             # Firelens. for compatibility
             self.__logdata_dict = dict(self.__logdata_dict, **logmeta)
+            self.__logdata_dict.pop('__raw_message', None)
         if self.is_ignored:
             return
         self.__event_ingested = datetime.now(timezone.utc)
@@ -558,9 +703,9 @@ class LogParser:
         if self.__logdata_dict.get('is_ignored'):
             self.ignored_reason = self.__logdata_dict.get('ignored_reason')
             return True
-        if self.logtype in self.exclude_log_patterns:
+        if self.flat_exclude_patterns:
             is_excluded, ex_pattern = utils.match_log_with_exclude_patterns(
-                self.__logdata_dict, self.exclude_log_patterns[self.logtype])
+                self.__logdata_dict, self.flat_exclude_patterns)
             if is_excluded:
                 self.ignored_reason = (
                     f'matched {ex_pattern} with exclude_log_patterns')
@@ -582,9 +727,9 @@ class LogParser:
             temp = self.__logdata_dict['__doc_id_suffix']
             del self.__logdata_dict['__doc_id_suffix']
             return '{0}_{1}'.format(self.__logdata_dict['@id'], temp)
-        if self.logconfig['doc_id_suffix']:
-            suffix = utils.value_from_nesteddict_by_dottedkey(
-                self.__logdata_dict, self.logconfig['doc_id_suffix'])
+        if self.doc_id_suffix_keypath:
+            suffix = utils.value_from_nesteddict_by_keypath(
+                self.__logdata_dict, self.doc_id_suffix_keypath)
             if suffix:
                 return '{0}_{1}'.format(self.__logdata_dict['@id'], suffix)
         return self.__logdata_dict['@id']
@@ -616,14 +761,10 @@ class LogParser:
 
     @property
     def json(self):
-        # 内部で管理用のフィールドを削除
+        # 内部で管理用のフィールドを削除。同時に大きすぎるフィールドを切り捨てて
+        # シリアライズは1回だけにする
         self.__logdata_dict = self.del_none(self.__logdata_dict)
-        loaded_data = json.dumps(self.__logdata_dict)
-        # サイズが Lucene の最大値である 32766 Byte を超えてるかチェック
-        if len(loaded_data) >= 65536:
-            self.__logdata_dict = self.truncate_big_field(self.__logdata_dict)
-            loaded_data = json.dumps(self.__logdata_dict)
-        return loaded_data
+        return self.dumps(self.__logdata_dict).decode()
 
     ###########################################################################
     # Method/Function - Main
@@ -633,94 +774,104 @@ class LogParser:
         if 'is_ignored' in logmeta or '__skip_normalization' in logmeta:
             return logdata_dict
 
-        if self.logformat in 'csv':
-            logdata_dict = dict(zip(self.header.split(), logdata.split()))
-            logdata_dict = utils.convert_keyname_to_safe_field(logdata_dict)
-        elif self.logformat in 'json':
+        if self.logformat == 'csv':
+            values = logdata.split()
+            if len(values) == self.csv_field_count:
+                logdata_dict = {
+                    key: values[i] for key, i in self.csv_safe_fields}
+            else:
+                logdata_dict = dict(zip(self.header.split(), values))
+                logdata_dict = utils.convert_keyname_to_safe_field(
+                    logdata_dict)
+        elif self.logformat == 'json':
             logdata_dict = logdata
-        elif self.logformat in ('winevtxml', ):
+        elif self.logformat == 'winevtxml':
             logdata_dict = winevtxml.to_dict(logdata)
-        elif self.logformat in ('xml', ):
-            logdata_dict = xmltodict.parse(logdata)
+        elif self.logformat == 'xml':
+            logdata_dict = utils.parse_xml(logdata)
         elif self.logformat in ('text', 'multiline'):
             logdata_dict = self.text_logdata_to_dict(logdata)
         return logdata_dict
 
     def add_basic_field(self):
         basic_dict = {}
-        if self.logformat in 'json':
-            basic_dict['@message'] = str(json.dumps(self.logdata))
+        if self.logformat == 'json':
+            if self.json_raw_message:
+                # 元のテキストがあれば再度シリアライズしない
+                raw_message = self.logmeta.get('__raw_message')
+            else:
+                raw_message = None
+            basic_dict['@message'] = utils.json_logdata_to_message(
+                self.logdata, raw_message)
         else:
             basic_dict['@message'] = str(self.logdata)
         basic_dict['event'] = {'module': self.logtype}
-        basic_dict['@timestamp'] = self.timestamp.isoformat()
-        basic_dict['event']['ingested'] = self.event_ingested.isoformat()
+        event_ingested = self.event_ingested.isoformat()
+        if self.timestamp is self.event_ingested:
+            basic_dict['@timestamp'] = event_ingested
+        else:
+            basic_dict['@timestamp'] = self.timestamp.isoformat()
+        basic_dict['event']['ingested'] = event_ingested
         basic_dict['@log_type'] = self.logtype
         if self.__skip_normalization:
-            unique_text = "{0}{1}".format(basic_dict['@message'], self.s3key)
-            basic_dict['@id'] = hashlib.md5(
-                unique_text.encode('utf-8')).hexdigest()
-        elif self.logconfig['doc_id']:
-            basic_dict['@id'] = self.__logdata_dict[self.logconfig['doc_id']]
+            # same digest as hashing "{@message}{s3key}"
+            h = self.doc_id_hash(basic_dict['@message'].encode('utf-8'))
+            h.update(self.s3key_bytes)
+            basic_dict['@id'] = h.hexdigest()
+        elif self.doc_id_key:
+            basic_dict['@id'] = self.__logdata_dict[self.doc_id_key]
         else:
-            basic_dict['@id'] = hashlib.md5(
-                str(basic_dict['@message']).encode('utf-8')).hexdigest()
+            basic_dict['@id'] = self.doc_id_hash(
+                basic_dict['@message'].encode('utf-8')).hexdigest()
         if self.loggroup:
             basic_dict['@log_group'] = self.loggroup
             basic_dict['@log_stream'] = self.logstream
         basic_dict['@log_s3bucket'] = self.s3bucket
         basic_dict['@log_s3key'] = self.s3key
-        self.__logdata_dict = utils.merge_dicts(
-            self.__logdata_dict, basic_dict)
+        # event 以外は文字列なので上書きするだけでよい
+        if isinstance(self.__logdata_dict.get('event'), dict):
+            self.__logdata_dict['event'].update(basic_dict['event'])
+            basic_dict['event'] = self.__logdata_dict['event']
+        self.__logdata_dict.update(basic_dict)
 
     def clean_multi_type_field(self):
         clean_multi_type_dict = {}
-        multifield_keys = self.logconfig['json_to_text'].split()
-        for multifield_key in multifield_keys:
-            v = utils.value_from_nesteddict_by_dottedkey(
-                self.__logdata_dict, multifield_key)
+        for multifield_key, keypath in self.multifield_keypaths:
+            v = utils.value_from_nesteddict_by_keypath(
+                self.__logdata_dict, keypath)
             if v:
                 # json obj in json obj
                 if isinstance(v, int):
-                    new_dict = utils.put_value_into_nesteddict(
-                        multifield_key, v)
+                    pass
                 elif '{' in v:
-                    new_dict = utils.put_value_into_nesteddict(
-                        multifield_key, repr(v))
+                    v = repr(v)
                 else:
-                    new_dict = utils.put_value_into_nesteddict(
-                        multifield_key, str(v))
-                clean_multi_type_dict = utils.merge_dicts(
-                    clean_multi_type_dict, new_dict)
-        self.__logdata_dict = utils.merge_dicts(
-            self.__logdata_dict, clean_multi_type_dict)
+                    v = str(v)
+                utils.merge_value_into_nesteddict(
+                    clean_multi_type_dict, multifield_key, v)
+        utils.merge_into(self.__logdata_dict, clean_multi_type_dict)
 
     def get_value_and_input_into_ecs_dict(self, ecs_dict):
-        new_ecs_dict = {}
-        ecs_keys = self.logconfig['ecs'].split()
-        for ecs_key in ecs_keys:
-            original_keys = self.logconfig[ecs_key]
-            if isinstance(original_keys, str):
-                v = utils.value_from_nesteddict_by_dottedkeylist(
-                    self.__logdata_dict, original_keys)
+        for ecs_key, keypaths, is_list in self.ecs_keypaths:
+            if not is_list:
+                v = utils.value_from_nesteddict_by_keypaths(
+                    self.__logdata_dict, keypaths)
                 if isinstance(v, str):
                     v = utils.validate_ip(v, ecs_key)
                 if v:
-                    new_ecs_dict = utils.put_value_into_nesteddict(ecs_key, v)
-            elif isinstance(original_keys, list):
+                    utils.merge_value_into_nesteddict(ecs_dict, ecs_key, v)
+            else:
                 temp_list = []
-                for original_key_list in original_keys:
-                    v = utils.value_from_nesteddict_by_dottedkeylist(
-                        self.__logdata_dict, original_key_list)
+                for original_keypaths in keypaths:
+                    v = utils.value_from_nesteddict_by_keypaths(
+                        self.__logdata_dict, original_keypaths)
                     if isinstance(v, str):
                         v = utils.validate_ip(v, ecs_key)
                     if v:
                         temp_list.append(v)
                 if temp_list:
-                    new_ecs_dict = utils.put_value_into_nesteddict(
-                        ecs_key, sorted(list(set(temp_list))))
-            if new_ecs_dict:
-                new_ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
+                    utils.merge_value_into_nesteddict(
+                        ecs_dict, ecs_key, sorted(list(set(temp_list))))
         return ecs_dict
 
     def transform_to_ecs(self):
@@ -729,30 +880,25 @@ class LogParser:
             ecs_dict['cloud'] = {'provider': self.logconfig['cloud_provider']}
         ecs_dict = self.get_value_and_input_into_ecs_dict(ecs_dict)
         if 'cloud' in ecs_dict:
+            cloud_dict = ecs_dict['cloud']
             # Set AWS Account ID
-            if ('account' in ecs_dict['cloud']
-                    and 'id' in ecs_dict['cloud']['account']):
-                if ecs_dict['cloud']['account']['id'] in ('unknown', ):
+            if 'account' in cloud_dict and 'id' in cloud_dict['account']:
+                if cloud_dict['account']['id'] == 'unknown':
                     # for vpcflowlogs
-                    ecs_dict['cloud']['account'] = {'id': self.accountid}
-            elif self.accountid:
-                ecs_dict['cloud']['account'] = {'id': self.accountid}
+                    cloud_dict['account'] = {'id': self.accountid}
             else:
-                ecs_dict['cloud']['account'] = {'id': 'unknown'}
+                cloud_dict['account'] = {'id': self.accountid or 'unknown'}
 
             # Set AWS Region
-            if 'region' in ecs_dict['cloud']:
-                pass
-            elif self.region:
-                ecs_dict['cloud']['region'] = self.region
-            else:
-                ecs_dict['cloud']['region'] = 'unknown'
+            if 'region' not in cloud_dict:
+                cloud_dict['region'] = self.region or 'unknown'
 
         # get info from firelens metadata of Elastic Container Serivce
         if 'ecs_task_arn' in self.logmeta:
-            ecs_task_arn_taple = self.logmeta['ecs_task_arn'].split(':')
-            ecs_dict['cloud']['account']['id'] = ecs_task_arn_taple[4]
-            ecs_dict['cloud']['region'] = ecs_task_arn_taple[3]
+            account_id, region = utils.parse_ecs_task_arn(
+                self.logmeta['ecs_task_arn'])
+            ecs_dict['cloud']['account']['id'] = account_id
+            ecs_dict['cloud']['region'] = region
             if 'ec2_instance_id' in self.logmeta:
                 ecs_dict['cloud']['instance'] = {
                     'id': self.logmeta['ec2_instance_id']}
@@ -765,23 +911,21 @@ class LogParser:
                 'message': self.logmeta['__error_message']}
             del self.__logdata_dict['__error_message']
 
-        static_ecs_keys = self.logconfig['static_ecs']
-        if static_ecs_keys:
-            for static_ecs_key in static_ecs_keys.split():
-                new_ecs_dict = utils.put_value_into_nesteddict(
-                    static_ecs_key, self.logconfig[static_ecs_key])
-                ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
-        self.__logdata_dict = utils.merge_dicts(self.__logdata_dict, ecs_dict)
+        for static_ecs_key, static_ecs_value in self.static_ecs_items:
+            utils.merge_value_into_nesteddict(
+                ecs_dict, static_ecs_key, static_ecs_value)
+        utils.merge_into(self.__logdata_dict, ecs_dict)
 
     def transform_by_script(self):
         if self.logconfig['script_ecs']:
             self.__logdata_dict = self.sf_module.transform(self.__logdata_dict)
 
     def enrich(self):
+        if not self.geoip_list:
+            return
         enrich_dict = {}
         # geoip
-        geoip_list = self.logconfig['geoip'].split()
-        for geoip_ecs in geoip_list:
+        for geoip_ecs in self.geoip_list:
             try:
                 ipaddr = self.__logdata_dict[geoip_ecs]['ip']
             except KeyError:
@@ -793,16 +937,14 @@ class LogParser:
                 enrich_dict[geoip_ecs].update({'as': asn})
             elif asn:
                 enrich_dict[geoip_ecs] = {'as': asn}
-        self.__logdata_dict = utils.merge_dicts(
-            self.__logdata_dict, enrich_dict)
+        utils.merge_into(self.__logdata_dict, enrich_dict)
 
     ###########################################################################
     # Method/Function - Support
     ###########################################################################
     def text_logdata_to_dict(self, logdata):
-        re_log_pattern_prog = self.logconfig['log_pattern']
+        re_log_pattern_prog = self.re_log_pattern
         try:
-            re_log_pattern_prog = self.logconfig['log_pattern']
             m = re_log_pattern_prog.match(logdata)
         except AttributeError:
             msg = 'No log_pattern. You need to define it in user.ini'
@@ -825,64 +967,92 @@ class LogParser:
         return False
 
     def get_timestamp(self):
-        if self.logconfig['timestamp_key'] and not self.__skip_normalization:
-            if self.logconfig['timestamp_key'] == 'cwe_timestamp':
+        timestamp_key = self.timestamp_key
+        if timestamp_key and not self.__skip_normalization:
+            if timestamp_key == 'cwe_timestamp':
                 self.__logdata_dict['cwe_timestamp'] = self.cwe_timestamp
-            elif self.logconfig['timestamp_key'] == 'cwl_timestamp':
+            elif timestamp_key == 'cwl_timestamp':
                 self.__logdata_dict['cwl_timestamp'] = self.cwl_timestamp
             timestr = utils.get_timestr_from_logdata_dict(
-                self.__logdata_dict, self.logconfig['timestamp_key'],
-                self.has_nanotime)
+                self.__logdata_dict, timestamp_key, self.has_nanotime)
             dt = utils.convert_timestr_to_datetime(
-                timestr, self.logconfig['timestamp_key'],
-                self.logconfig['timestamp_format'], self.timestamp_tz)
+                timestr, timestamp_key, self.timestamp_format,
+                self.timestamp_tz)
             if not dt:
                 msg = f'there is no timestamp format for {self.logtype}'
                 logger.error(msg)
                 raise ValueError(msg)
         else:
-            dt = datetime.now(timezone.utc)
+            # タイムスタンプがないログは取り込み時刻を使い、時刻の取得を1回で済ます
+            dt = self.__event_ingested
         return dt
 
-    def del_none(self, d):
-        """値のないキーを削除する。削除しないとESへのLoad時にエラーとなる """
-        for key, value in list(d.items()):
-            if isinstance(value, dict):
-                self.del_none(value)
-            if isinstance(value, dict) and len(value) == 0:
-                del d[key]
-            elif isinstance(value, list) and len(value) == 0:
-                del d[key]
-            elif isinstance(value, str) and (value in ('', '-', 'null', '[]')):
-                del d[key]
-            elif isinstance(value, type(None)):
-                del d[key]
-        return d
-
-    def truncate_txt(self, txt, num):
+    def dumps(self, d):
+        if orjson is None:
+            return json.dumps(d).encode()
         try:
-            return txt.encode('utf-8')[:num].decode()
-        except UnicodeDecodeError:
-            return self.truncate_txt(txt, num - 1)
+            return orjson.dumps(d)
+        except TypeError:
+            # orjson doesn't support integer bigger than 64-bit
+            return json.dumps(d).encode()
 
-    def truncate_big_field(self, d):
-        """ truncate big field if size is bigger than 32,766 byte
+    def del_none(self, d):
+        """値のないキーを削除する。削除しないとESへのLoad時にエラーとなる
 
-        field size が Lucene の最大値である 32766 Byte を超えてるかチェック
+        field size が Lucene の最大値である 32766 Byte を超えてるかもチェック
         超えてれば切り捨て。このサイズは lucene の制限値
+        削除と切り捨ては同じ走査で行うので、json 化の前にはこれだけを呼ぶ
         """
-        for key, value in list(d.items()):
-            if isinstance(value, dict):
-                self.truncate_big_field(value)
-            elif (isinstance(value, str) and (len(value) >= 16383)
-                    and len(value.encode('utf-8')) >= 32766):
-                if key not in ("@message", ):
-                    d[key] = self.truncate_txt(d[key], 32753) + '<<TRUNCATED>>'
-                    logger.warn(
-                        f'Data was truncated because the size of {key} field '
-                        f'is bigger than 32,766. _id is {self.doc_id}')
+        # 再帰呼び出しをせずにスタックで辿る。子の dict は親より後に visited に
+        # 入るので、逆順に見ていけば空になった dict を下の階層から削除できる
+        visited = []
+        stack = [(None, None, d)]
+        while stack:
+            parent, parent_key, current = stack.pop()
+            visited.append((parent, parent_key, current))
+            empty_keys = []
+            for key, value in current.items():
+                # 件数の多い str から判定する
+                if isinstance(value, str):
+                    if value in EMPTY_STR_VALUES:
+                        empty_keys.append(key)
+                    elif len(value) >= 8192 and key not in ("@message", ):
+                        # 1文字は最大4バイトなので、8192文字未満なら
+                        # エンコードしなくても 32766 バイト未満とわかる
+                        value_bytes = value.encode('utf-8')
+                        if len(value_bytes) >= 32766:
+                            current[key] = (
+                                self.truncate_bytes(value_bytes, 32753)
+                                + '<<TRUNCATED>>')
+                            logger.warn(
+                                f'Data was truncated because the size of '
+                                f'{key} field is bigger than 32,766. '
+                                f'_id is {self.doc_id}')
+                elif isinstance(value, dict):
+                    if value:
+                        stack.append((current, key, value))
+                    else:
+                        empty_keys.append(key)
+                elif value is None or (isinstance(value, list) and not value):
+                    empty_keys.append(key)
+            for key in empty_keys:
+                del current[key]
+        for parent, parent_key, current in reversed(visited):
+            if parent is not None and not current:
+                del parent[parent_key]
         return d
 
+    def truncate_txt(self, txt, num):
+        return self.truncate_bytes(txt.encode('utf-8'), num)
+
+    def truncate_bytes(self, txt_bytes, num):
+        # 切り捨て位置を UTF-8 の文字の先頭まで戻す
+        if len(txt_bytes) <= num:
+            return txt_bytes.decode('utf-8', 'ignore')
+        while num > 0 and (txt_bytes[num] & 0xC0) == 0x80:
+            num -= 1
+        return txt_bytes[:num].decode('utf-8', 'ignore')
+
 
 ###############################################################################
 # DEPRECATED function. Moved to siem.utils
@@ -908,21 +1078,10 @@ def get_value_from_dict(dct, xkeys_list):
     >>> xkeys_list = 'a.b.0.c'
     >>> get_value_from_dict(dct, xkeys_list)
     123
+    >>> get_value_from_dict(dct, utils.compile_dotted_keylist(xkeys_list))
+    123
     """
-    for xkeys in xkeys_list.split():
-        v = dct
-        for k in xkeys.split('.'):
-            try:
-                k = int(k)
-            except ValueError:
-                pass
-            try:
-                v = v[k]
-            except (TypeError, KeyError, IndexError):
-                v = ''
-                break
-        if v:
-            return v
+    return utils.value_from_nesteddict_by_dottedkeylist(dct, xkeys_list)
 
 
 def put_value_into_dict(key_str, v):
@@ -932,7 +1091,6 @@ def put_value_into_dict(key_str, v):
     dictのkeyにドットが含まれている場合に入れ子になったdictを作成し、値としてvを入れる.
     返値はdictタイプ。vが辞書ならさらに入れ子として代入。
     値がlistなら、カンマ区切りのCSVにした文字列に変換
-    TODO: 値に"が入ってると例外になる。対処方法が見つからず返値なDROPPEDにしてるので改善する。#34
 
     >>> put_value_into_dict('a.b.c', 123)
     {'a': {'b': {'c': '123'}}}
@@ -943,119 +1101,24 @@ def put_value_into_dict(key_str, v):
     >>> v = {'x': 1, 'y': 2}
     >>> put_value_into_dict('a.b.c', v)
     {'a': {'b': {'c': {'x': 1, 'y': 2}}}}
-    >>> v = str({'x': "1", 'y': '2"3'})
-    >>> put_value_into_dict('a.b.c', v)
-    {'a': {'b': {'c': 'DROPPED'}}}
+    >>> put_value_into_dict('a.b.c', '2"3')
+    {'a': {'b': {'c': '2"3'}}}
     """
-    v = v
-    xkeys = key_str.split('.')
     if isinstance(v, dict):
-        json_data = r'{{"{0}": {1} }}'.format(xkeys[-1], json.dumps(v))
+        new_dict = v
     elif isinstance(v, list):
-        json_data = r'{{"{0}": "{1}" }}'.format(
-            xkeys[-1], ",".join(map(str, v)))
+        new_dict = ",".join(map(str, v))
     else:
-        json_data = r'{{"{0}": "{1}" }}'.format(xkeys[-1], v)
-    if len(xkeys) >= 2:
-        xkeys.pop()
-        for xkey in reversed(xkeys):
-            json_data = r'{{"{0}": {1} }}'.format(xkey, json_data)
-    try:
-        new_dict = json.loads(json_data, strict=False)
-    except json.decoder.JSONDecodeError:
-        new_dict = put_value_into_dict(key_str, 'DROPPED')
+        new_dict = str(v)
+    for xkey in reversed(key_str.split('.')):
+        new_dict = {xkey: new_dict}
     return new_dict
 
 
-def conv_key(obj):
-    """Deprecated.
-
-    moved to utils.convert_key_to_safe_field
-    dictのkeyに-が入ってたら_に置換する
-    """
-    if isinstance(obj, dict):
-        for org_key in list(obj.keys()):
-            new_key = org_key
-            if '-' in org_key:
-                new_key = org_key.translate({ord('-'): ord('_')})
-                obj[new_key] = obj.pop(org_key)
-            utils.conv_key(obj[new_key])
-    elif isinstance(obj, list):
-        for val in obj:
-            utils.conv_key(val)
-    else:
-        pass
-
-
 def merge(a, b, path=None):
     """Deprecated.
 
     merges b into a
     Moved to siem.utils.merge_dicts.
     """
-    if path is None:
-        path = []
-    for key in b:
-        if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
-                merge(a[key], b[key], path + [str(key)])
-            elif a[key] == b[key]:
-                pass  # same leaf value
-            elif str(a[key]) in str(b[key]):
-                # strで上書き。JSONだったのをstrに変換したデータ
-                a[key] = b[key]
-            else:
-                # conflict and override original value with new one
-                a[key] = b[key]
-        else:
-            a[key] = b[key]
-    return a
-
-
-def match_log_with_exclude_patterns(log_dict, log_patterns):
-    """Deprecated.
-
-    ログと、log_patterns を比較させる
-    一つでもマッチングされれば、Amazon ESにLoadしない
-
-    >>> pattern1 = 111
-    >>> RE_BINGO = re.compile('^'+str(pattern1)+'$')
-    >>> pattern2 = 222
-    >>> RE_MISS = re.compile('^'+str(pattern2)+'$')
-    >>> log_patterns = { \
-    'a': RE_BINGO, 'b': RE_MISS, 'x': {'y': {'z': RE_BINGO}}}
-    >>> log_dict = {'a': 111}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-    True
-    >>> log_dict = {'a': 21112}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-
-    >>> log_dict = {'a': '111'}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-    True
-    >>> log_dict = {'aa': 222, 'a': 111}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-    True
-    >>> log_dict = {'x': {'y': {'z': 111}}}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-    True
-    >>> log_dict = {'x': {'y': {'z': 222}}}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-
-    >>> log_dict = {'x': {'hoge':222, 'y': {'z': 111}}}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-    True
-    >>> log_dict = {'a': 222}
-    >>> match_log_with_exclude_patterns(log_dict, log_patterns)
-
-    """
-    for key, pattern in log_patterns.items():
-        if key in log_dict:
-            if isinstance(pattern, dict) and isinstance(log_dict[key], dict):
-                res = match_log_with_exclude_patterns(log_dict[key], pattern)
-                return res
-            elif isinstance(pattern, re.Pattern):
-                if isinstance(log_dict[key], list):
-                    pass
-                elif pattern.match(str(log_dict[key])):
-                    return True
+    return utils.merge_dicts(a, b)
@@ -5,6 +5,7 @@ import configparser
 import csv
 import importlib
 import ipaddress
+import json
 import os
 import re
 import sys
@@ -15,8 +16,20 @@ import boto3
 import botocore
 from aws_lambda_powertools import Logger
 from elasticsearch import Elasticsearch, RequestsHttpConnection
+from lxml import etree
 from requests_aws4auth import AWS4Auth
 
+try:
+    # optional. なければ json で読み込む
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # optional. Lambda Layer などで追加すれば text ログの正規表現に使う
+    import re2
+except ImportError:
+    re2 = None
+
 __version__ = '2.5.0'
 
 logger = Logger(child=True)
@@ -38,6 +51,20 @@ MONTH_TO_INT = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
                 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 NOW = datetime.now(timezone.utc)
 TD_OFFSET12 = timedelta(hours=12)
+# strptime と同じ正規表現。compile_timestamp_format で使う
+TIMESTAMP_DIRECTIVES = {
+    'Y': r'(?P<Y>\d\d\d\d)',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'b': r'(?P<b>' + '|'.join(MONTH_TO_INT) + ')',
+    'd': r'(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])',
+    'H': r'(?P<H>2[0-3]|[0-1]\d|\d)',
+    'M': r'(?P<M>[0-5]\d|\d)',
+    'S': r'(?P<S>6[0-1]|[0-5]\d|\d)',
+    'f': r'(?P<f>[0-9]{1,6})',
+    'z': r'(?P<z>[+-]\d\d:?[0-5]\d)',
+}
+# for field name
+HYPHEN_TO_UNDERSCORE = str.maketrans('-', '_')
 
 
 def extract_aws_account_from_text(text):
@@ -127,6 +154,17 @@ def validate_ip(value, ecs_key):
         return value
 
 
+@lru_cache(maxsize=1024)
+def parse_ecs_task_arn(ecs_task_arn):
+    """return account id and region of ECS task arn.
+
+    >>> parse_ecs_task_arn('arn:aws:ecs:ap-northeast-1:123456789012:task/x')
+    ('123456789012', 'ap-northeast-1')
+    """
+    ecs_task_arn_taple = ecs_task_arn.split(':')
+    return ecs_task_arn_taple[4], ecs_task_arn_taple[3]
+
+
 #############################################################################
 # date time
 #############################################################################
@@ -239,9 +277,93 @@ def convert_iso8601_to_datetime(timestr, TZ, timestamp_key):
     return dt
 
 
+@lru_cache(maxsize=128)
+def compile_timestamp_format(timestamp_format):
+    """compile strptime format into regex.
+
+    よく使う書式だけを、strptime と同じ正規表現に変換する。
+    対応していない書式なら None を返して strptime を使う
+
+    >>> re_format = compile_timestamp_format('%Y-%m-%d %H:%M:%S,%f')
+    >>> re_format.match('2021-05-01 00:10:20,123').group('f')
+    '123'
+    >>> compile_timestamp_format('%I:%M %p')
+
+    """
+    regex = []
+    directives = set()
+    i = 0
+    while i < len(timestamp_format):
+        char = timestamp_format[i]
+        if char == '%':
+            directive = timestamp_format[i + 1:i + 2]
+            if (directive not in TIMESTAMP_DIRECTIVES
+                    or directive in directives):
+                return None
+            directives.add(directive)
+            regex.append(TIMESTAMP_DIRECTIVES[directive])
+            i += 2
+        elif char.isspace():
+            while (i < len(timestamp_format)
+                    and timestamp_format[i].isspace()):
+                i += 1
+            regex.append(r'\s+')
+        else:
+            regex.append(re.escape(char))
+            i += 1
+    return re.compile(''.join(regex), re.IGNORECASE)
+
+
+def parse_timestr_by_compiled_format(timestr, re_timestamp_format):
+    """parse timestr like strptime with regex of compile_timestamp_format.
+
+    strptime と同じ値を返す。解析できなければ None を返す
+
+    >>> re_format = compile_timestamp_format('%d/%b/%Y:%H:%M:%S %z')
+    >>> parse_timestr_by_compiled_format(
+    ...     '01/May/2021:00:10:20 +0900', re_format).isoformat()
+    '2021-05-01T00:10:20+09:00'
+    >>> parse_timestr_by_compiled_format('01/May/2021:00:10:20', re_format)
+
+    """
+    # strptime と同様に先頭から match し、末尾まで一致しなければ失敗とする
+    m = re_timestamp_format.match(timestr)
+    if not m or m.end() != len(timestr):
+        return None
+    group = m.groupdict()
+    if group.get('b'):
+        month = MONTH_TO_INT[group['b'].title()]
+    else:
+        month = int(group.get('m') or 1)
+    microsecond = 0
+    if group.get('f'):
+        microsecond = int(group['f'].ljust(6, '0'))
+    tzinfo = None
+    try:
+        if group.get('z'):
+            offset = group['z'].replace(':', '')
+            tzdelta = timedelta(
+                hours=int(offset[1:3]), minutes=int(offset[3:5]))
+            tzinfo = timezone(-tzdelta if offset[0] == '-' else tzdelta)
+        return datetime(
+            int(group.get('Y') or 1900), month, int(group.get('d') or 1),
+            int(group.get('H') or 0), int(group.get('M') or 0),
+            int(group.get('S') or 0), microsecond, tzinfo)
+    except ValueError:
+        # strptime で同じエラーを出す
+        return None
+
+
 @lru_cache(maxsize=10000)
 def convert_custom_timeformat_to_datetime(timestr, TZ, timestamp_format,
                                           timestamp_key):
+    re_timestamp_format = compile_timestamp_format(timestamp_format)
+    if re_timestamp_format and isinstance(timestr, str):
+        dt = parse_timestr_by_compiled_format(timestr, re_timestamp_format)
+        if dt:
+            if not dt.tzinfo:
+                dt = dt.replace(tzinfo=TZ)
+            return dt
     try:
         dt = datetime.strptime(timestr, timestamp_format)
     except ValueError:
@@ -439,7 +561,15 @@ def merge_dotted_key_value_into_dict(patterns_dict, dotted_key, value):
     key_list = dotted_key.split('.')
     for key in key_list[:-1]:
         patterns_dict_temp = patterns_dict_temp.setdefault(key, {})
-    patterns_dict_temp[key_list[-1]] = value
+    # 同じフィールドに複数の除外パターンがあれば上書きせずにリストにする
+    current_value = patterns_dict_temp.get(key_list[-1])
+    if isinstance(value, re.Pattern) and isinstance(current_value, list):
+        current_value.append(value)
+    elif isinstance(value, re.Pattern) and isinstance(
+            current_value, re.Pattern):
+        patterns_dict_temp[key_list[-1]] = [current_value, value]
+    else:
+        patterns_dict_temp[key_list[-1]] = value
     return patterns_dict
 
 
@@ -499,6 +629,248 @@ def get_mime_type(data):
         return 'text'
 
 
+# orjson は 64bit を超える整数を float にしてしまうので json で読み込む
+RE_BIG_INTEGER = re.compile(r'\d{19,}')
+
+
+def loads_json(text):
+    """load json text with orjson if it is installed. fall back to json.
+
+    orjson が扱えない 64bit を超える整数、NaN、Infinity、サロゲート文字を
+    含む場合は json.loads で読み込み、従来と同じ値を返す
+
+    >>> loads_json('{"a": 1, "b": [true, null]}')
+    {'a': 1, 'b': [True, None]}
+    >>> loads_json('{"big": 12345678901234567890123}')
+    {'big': 12345678901234567890123}
+    >>> loads_json('{"a": NaN}')
+    {'a': nan}
+    >>> loads_json('{"a": "\\ud83d"}')
+    {'a': '\ud83d'}
+    """
+    if orjson is None or RE_BIG_INTEGER.search(text):
+        return json.loads(text)
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return json.loads(text)
+
+
+def json_logdata_to_message(logdata, raw_message=None):
+    """create @message of json log.
+
+    doc_id がないログの @id は @message のハッシュ値なので、raw_message が
+    なければ json.dumps で従来と同じ文字列を作る。raw_message は
+    json_raw_message = True のログ種類だけで渡す
+
+    >>> import hashlib
+    >>> logdata = {'action': 'ALLOW', 'httpRequest': {'clientIp': '192.0.2.1'}}
+    >>> message = json_logdata_to_message(logdata)
+    >>> message
+    '{"action": "ALLOW", "httpRequest": {"clientIp": "192.0.2.1"}}'
+    >>> hashlib.md5(message.encode('utf-8')).hexdigest()
+    '07a009bc706aa600f55baecf198872f2'
+    >>> json_logdata_to_message({'a': 1}, raw_message='{"a":1}')
+    '{"a":1}'
+    """
+    return raw_message or json.dumps(logdata)
+
+
+def count_lines(data):
+    r"""count lines of bytes in the same way as universal newlines mode.
+
+    \n, \r\n and \r are line boundaries. readlines() を使わずに数える
+
+    >>> count_lines(b'a\nb\r\nc\rd')
+    4
+    >>> count_lines(b'a\nb\n')
+    2
+    >>> count_lines(b'\r\n\n')
+    2
+    >>> count_lines(b'')
+    0
+    """
+    count = data.count(b'\n') + data.count(b'\r') - data.count(b'\r\n')
+    if data and data[-1:] not in (b'\n', b'\r'):
+        # last line without newline
+        count += 1
+    return count
+
+
+# 先読み、後読み、後方参照は re2 では使えない
+RE_UNSUPPORTED_BY_RE2 = re.compile(r'\(\?(?:[=!]|<[=!]|P=)|\\[1-9]')
+
+
+def compile_log_pattern_with_re2(re_pattern):
+    """compile log pattern with re2 if it is installed.
+
+    use_re2 = True のログ種類で使う。
+    re2 はバックトラックしないので長い行でも線形時間で match できる。
+    re2 がない、または re2 で扱えないパターンなら re_pattern をそのまま返す。
+    re2 の \\d、\\s、\\w は ASCII のみにマッチする
+
+    >>> re_pattern = re.compile(r'(?P<a>\\S+) (?=x)')
+    >>> compile_log_pattern_with_re2(re_pattern) is re_pattern
+    True
+    >>> compile_log_pattern_with_re2('')
+    ''
+    """
+    if re2 is None or not isinstance(re_pattern, re.Pattern):
+        return re_pattern
+    if (not isinstance(re_pattern.pattern, str)
+            or re_pattern.flags != re.UNICODE
+            or RE_UNSUPPORTED_BY_RE2.search(re_pattern.pattern)):
+        return re_pattern
+    try:
+        return re2.compile(re_pattern.pattern)
+    except Exception:
+        logger.info(f'{re_pattern.pattern} is not supported by re2')
+        return re_pattern
+
+
+XML_PARSE_ERRORS = (etree.XMLSyntaxError, )
+XML_PARSER = etree.XMLParser(
+    encoding='utf-8', resolve_entities=False, no_network=True,
+    huge_tree=True)
+
+
+@lru_cache(maxsize=1024)
+def _lxml_tagname(tag, prefix):
+    # {uri}localname -> prefix:localname
+    localname = tag.rpartition('}')[2]
+    if prefix:
+        return f'{prefix}:{localname}'
+    return localname
+
+
+def _lxml_attrname(name, nsmap):
+    uri, localname = name[1:].split('}', 1)
+    if uri == 'http://www.w3.org/XML/1998/namespace':
+        return f'xml:{localname}'
+    for prefix, value in nsmap.items():
+        # default namespace is not applied to attribute
+        if prefix and value == uri:
+            return f'{prefix}:{localname}'
+    return localname
+
+
+def _lxml_element_to_dict(elem, nsmap, parent_nsmap, attr_prefix,
+                          strip_whitespace):
+    item = {}
+    if nsmap != parent_nsmap:
+        # namespace declarations are attributes in xmltodict
+        for prefix, uri in nsmap.items():
+            if parent_nsmap.get(prefix) != uri:
+                key = f'xmlns:{prefix}' if prefix else 'xmlns'
+                item[attr_prefix + key] = uri
+    for key, value in elem.attrib.items():
+        if key[0] == '{':
+            key = _lxml_attrname(key, nsmap)
+        item[attr_prefix + key] = value
+    data = [elem.text] if elem.text else []
+    for child in elem:
+        if isinstance(child.tag, str):
+            # skip comment and processing instruction
+            key = _lxml_tagname(child.tag, child.prefix)
+            value = _lxml_element_to_dict(
+                child, child.nsmap, nsmap, attr_prefix, strip_whitespace)
+            if key not in item:
+                item[key] = value
+            elif isinstance(item[key], list):
+                item[key].append(value)
+            else:
+                item[key] = [item[key], value]
+        if child.tail:
+            data.append(child.tail)
+    data = ''.join(data) or None
+    if strip_whitespace and data:
+        data = data.strip() or None
+    if not item:
+        return data
+    if data:
+        item['#text'] = data
+    return item
+
+
+def parse_xml(xml_text, attr_prefix='@', strip_whitespace=True):
+    """parse xml text into dict with lxml. same result as xmltodict.parse.
+
+    lxml は必須の依存ライブラリ。xmltodict は実行時には使わず、
+    doctest で結果を比較するためだけに requirements-dev.txt で入れる
+
+    >>> import xmltodict
+    >>> xml_text = '<a x="1"><b>text</b><b> </b><!-- c --><c/>tail</a>'
+    >>> parse_xml(xml_text) == xmltodict.parse(xml_text)
+    True
+    >>> xml_text = '<a xmlns="urn:x" xmlns:p="urn:p"><p:b p:y="2"> </p:b></a>'
+    >>> (parse_xml(xml_text, attr_prefix='', strip_whitespace=None)
+    ...  == xmltodict.parse(xml_text, attr_prefix='', strip_whitespace=None))
+    True
+    >>> xml_text = '<a><b xmlns="urn:b" xmlns:q="urn:q"><q:c q:z="3"/></b></a>'
+    >>> parse_xml(xml_text) == xmltodict.parse(xml_text)
+    True
+    """
+    root = etree.fromstring(xml_text.encode('utf-8'), XML_PARSER)
+    key = _lxml_tagname(root.tag, root.prefix)
+    return {key: _lxml_element_to_dict(
+        root, root.nsmap, {}, attr_prefix, strip_whitespace)}
+
+
+@lru_cache(maxsize=10000)
+def compile_dotted_key(dotted_key):
+    """split dotted key into tuple of keys. digit is converted to list index.
+
+    >>> compile_dotted_key('a.b.0.d0')
+    ('a', 'b', 0, 'd0')
+    """
+    return tuple(int(key) if key.isdigit() else key
+                 for key in dotted_key.split('.'))
+
+
+@lru_cache(maxsize=10000)
+def compile_dotted_keylist(dotted_key_list):
+    """split space separated dotted keys into tuple of compile_dotted_key.
+
+    >>> compile_dotted_keylist('a.b.c1 a.b.c2')
+    (('a', 'b', 'c1'), ('a', 'b', 'c2'))
+    """
+    return tuple(compile_dotted_key(dotted_key)
+                 for dotted_key in dotted_key_list.split())
+
+
+def value_from_nesteddict_by_keypath(nested_dict, keypath):
+    """get value form nested dict by keypath of compile_dotted_key.
+
+    >>> nested_dict = {'a': {'b': [{'d0': 123}, {'d1': 456}]}}
+    >>> value_from_nesteddict_by_keypath(nested_dict, ('a', 'b', 1, 'd1'))
+    456
+    >>> value_from_nesteddict_by_keypath(nested_dict, ('a', 'x'))
+
+    """
+    value = nested_dict
+    for key in keypath:
+        try:
+            value = value[key]
+        except (TypeError, KeyError, IndexError):
+            return None
+    if value:
+        return value
+
+
+def value_from_nesteddict_by_keypaths(nested_dict, keypaths):
+    """get 1st value form nested dict by keypaths of compile_dotted_key.
+
+    >>> nested_dict = {'a': {'b': {'c1': 123, 'c2': 456}}}
+    >>> keypaths = (('z', 'z'), ('a', 'b', 'c2'), ('a', 'b', 'c1'))
+    >>> value_from_nesteddict_by_keypaths(nested_dict, keypaths)
+    456
+    """
+    for keypath in keypaths:
+        value = value_from_nesteddict_by_keypath(nested_dict, keypath)
+        if value:
+            return value
+
+
 def value_from_nesteddict_by_dottedkey(nested_dict, dotted_key):
     """get value form nested dict by dotted key.
 
@@ -519,17 +891,8 @@ def value_from_nesteddict_by_dottedkey(nested_dict, dotted_key):
     >>> value_from_nesteddict_by_dottedkey(nested_dict, dotted_key)
     123
     """
-    value = nested_dict
-    for key in dotted_key.split('.'):
-        if key.isdigit():
-            key = int(key)
-        try:
-            value = value[key]
-        except (TypeError, KeyError, IndexError):
-            value = ''
-            break
-    if value:
-        return value
+    return value_from_nesteddict_by_keypath(
+        nested_dict, compile_dotted_key(dotted_key))
 
 
 def value_from_nesteddict_by_dottedkeylist(nested_dict, dotted_key_list):
@@ -546,15 +909,19 @@ def value_from_nesteddict_by_dottedkeylist(nested_dict, dotted_key_list):
     >>> dotted_key_list = 'z.z.z.z.z.z a.b.c1 a.b.c2'
     >>> value_from_nesteddict_by_dottedkeylist(nested_dict, dotted_key_list)
     123
+    >>> keypaths = compile_dotted_keylist(dotted_key_list)
+    >>> value_from_nesteddict_by_dottedkeylist(nested_dict, keypaths)
+    123
     """
+    # compile_dotted_keylist で分解済みのタプルならそのまま使う
     if isinstance(dotted_key_list, str):
-        dotted_key_list = dotted_key_list.split()
+        keypaths = compile_dotted_keylist(dotted_key_list)
     elif isinstance(dotted_key_list, list):
-        pass
-    for dotted_key in dotted_key_list:
-        value = value_from_nesteddict_by_dottedkey(nested_dict, dotted_key)
-        if value:
-            return value
+        keypaths = tuple(compile_dotted_key(dotted_key)
+                         for dotted_key in dotted_key_list)
+    else:
+        keypaths = dotted_key_list
+    return value_from_nesteddict_by_keypaths(nested_dict, keypaths)
 
 
 def put_value_into_nesteddict(dotted_key, value):
@@ -575,18 +942,42 @@ def put_value_into_nesteddict(dotted_key, value):
     >>> put_value_into_nesteddict('a.b.c', '"')
     {'a': {'b': {'c': '"'}}}
     """
-    if (isinstance(value, dict) or isinstance(value, str)
-            or isinstance(value, list)):
-        value = value
-    else:
+    if not isinstance(value, (dict, str, list)):
         value = str(value)
-    nested_dict = {}
-    keys, current = dotted_key.split('.'), nested_dict
-    for p in keys[:-1]:
-        current[p] = {}
-        current = current[p]
+    for key in reversed(dotted_key.split('.')):
+        value = {key: value}
+    return value
+
+
+def merge_value_into_nesteddict(nested_dict, dotted_key, value):
+    """put value into nested dict by dotted key in place.
 
-    current[keys[-1]] = value
+    merge_dicts(nested_dict, put_value_into_nesteddict(dotted_key, value))
+    と同じ結果を、一時的な dict を作らずに得る
+
+    >>> merge_value_into_nesteddict({'a': {'x': 1}}, 'a.b.c', 123)
+    {'a': {'x': 1, 'b': {'c': '123'}}}
+    >>> merge_value_into_nesteddict({'a': 'text'}, 'a.b', [123])
+    {'a': {'b': [123]}}
+    >>> merge_value_into_nesteddict({'a': {'x': 1}}, 'a', {'y': 2})
+    {'a': {'x': 1, 'y': 2}}
+    """
+    if not isinstance(value, (dict, str, list)):
+        value = str(value)
+    keys = dotted_key.split('.')
+    current = nested_dict
+    for i, key in enumerate(keys[:-1]):
+        child = current.get(key)
+        if not isinstance(child, dict):
+            current[key] = put_value_into_nesteddict(
+                '.'.join(keys[i + 1:]), value)
+            return nested_dict
+        current = child
+    key = keys[-1]
+    if isinstance(value, dict) and isinstance(current.get(key), dict):
+        merge_into(current[key], value)
+    else:
+        current[key] = value
     return nested_dict
 
 
@@ -599,7 +990,7 @@ def convert_keyname_to_safe_field(obj):
         for org_key in list(obj.keys()):
             new_key = org_key
             if '-' in org_key:
-                new_key = org_key.translate({ord('-'): ord('_')})
+                new_key = org_key.translate(HYPHEN_TO_UNDERSCORE)
                 obj[new_key] = obj.pop(org_key)
             convert_keyname_to_safe_field(obj[new_key])
     elif isinstance(obj, list):
@@ -610,11 +1001,73 @@ def convert_keyname_to_safe_field(obj):
     return obj
 
 
-def match_log_with_exclude_patterns(log_dict, log_patterns, ex_pattern=None):
+def flatten_exclude_patterns(log_patterns):
+    """flatten nested exclude patterns.
+
+    ネストされた log_patterns を (キーのタプル, 正規表現) のリストに変換する。
+    ログ毎に辞書を再帰的に辿らずに済むように、ファイル毎に1回だけ実行する。
+    同じフィールドに複数のパターンがあれば、1つの正規表現にまとめる
+
+    >>> RE_BINGO = re.compile('^111$')
+    >>> flatten_exclude_patterns({'a': RE_BINGO, 'x': {'y': RE_BINGO}})
+    [(('a',), re.compile('^111$')), (('x', 'y'), re.compile('^111$'))]
+    >>> flatten_exclude_patterns({'a': [re.compile('1$'), re.compile('2$')]})
+    [(('a',), re.compile('(?:1$)|(?:2$)'))]
+    >>> flatten_exclude_patterns(None)
+    []
+    """
+    flat_patterns = []
+    if not log_patterns:
+        return flat_patterns
+    stack = [((), log_patterns)]
+    while stack:
+        parent_keys, patterns = stack.pop()
+        for key, pattern in patterns.items():
+            keypath = parent_keys + (key, )
+            if isinstance(pattern, dict):
+                stack.append((keypath, pattern))
+            elif isinstance(pattern, re.Pattern):
+                flat_patterns.append((keypath, pattern))
+            elif isinstance(pattern, list):
+                for combined_pattern in combine_exclude_patterns(pattern):
+                    flat_patterns.append((keypath, combined_pattern))
+    return flat_patterns
+
+
+def combine_exclude_patterns(patterns):
+    """combine regex patterns of same field into one alternation.
+
+    match() で先頭から比較するので、パターン毎に match するのと同じ結果になる。
+    グループ(後方参照)やフラグを含むパターンは番号や意味が変わるのでまとめない
+
+    >>> combine_exclude_patterns([re.compile('a$'), re.compile('b$')])
+    [re.compile('(?:a$)|(?:b$)')]
+    >>> combine_exclude_patterns([re.compile('(a|b)$'), re.compile('c$')])
+    [re.compile('c$'), re.compile('(a|b)$')]
+    """
+    simple_patterns = []
+    other_patterns = []
+    for pattern in patterns:
+        if (isinstance(pattern.pattern, str) and pattern.groups == 0
+                and pattern.flags == re.UNICODE):
+            simple_patterns.append(pattern)
+        else:
+            other_patterns.append(pattern)
+    if len(simple_patterns) >= 2:
+        try:
+            simple_patterns = [re.compile('|'.join(
+                f'(?:{pattern.pattern})' for pattern in simple_patterns))]
+        except re.error:
+            pass
+    return simple_patterns + other_patterns
+
+
+def match_log_with_exclude_patterns(log_dict, log_patterns):
     """match log with exclude patterns.
 
     ログと、log_patterns を比較させる
     一つでもマッチングされれば、Amazon ESにLoadしない
+    log_patterns には flatten_exclude_patterns でフラット化したリストも渡せる
 
     >>> pattern1 = 111
     >>> RE_BINGO = re.compile('^'+str(pattern1)+'$')
@@ -646,27 +1099,60 @@ def match_log_with_exclude_patterns(log_dict, log_patterns, ex_pattern=None):
     >>> log_dict = {'a': 222}
     >>> match_log_with_exclude_patterns(log_dict, log_patterns)
     (False, None)
+    >>> flat_patterns = flatten_exclude_patterns(log_patterns)
+    >>> log_dict = {'a': [111], 'x': {'y': {'z': 111}}}
+    >>> match_log_with_exclude_patterns(log_dict, flat_patterns)
+    (True, '{z: 111}')
 
     """
-    for key, pattern in log_patterns.items():
-        if key in log_dict:
-            if isinstance(pattern, dict) and isinstance(log_dict[key], dict):
-                res, ex_pattern = match_log_with_exclude_patterns(
-                    log_dict[key], pattern)
-                return(res, ex_pattern)
-            elif isinstance(pattern, re.Pattern):
-                if isinstance(log_dict[key], list):
-                    return(False, None)
-                elif pattern.match(str(log_dict[key])):
-                    ex_pattern = '{{{0}: {1}}}'.format(key, log_dict[key])
-                    return(True, ex_pattern)
+    if isinstance(log_patterns, dict):
+        log_patterns = flatten_exclude_patterns(log_patterns)
+    for keypath, pattern in log_patterns:
+        value = log_dict
+        for key in keypath:
+            if not isinstance(value, dict):
+                value = None
+                break
+            value = value.get(key)
+        if value is None or isinstance(value, (dict, list)):
+            continue
+        if pattern.match(value if isinstance(value, str) else str(value)):
+            return(True, '{{{0}: {1}}}'.format(keypath[-1], value))
     return(False, None)
 
 
+def merge_into(dicta, dictb):
+    """merge dictb into dicta in place.
+
+    入れ子の dict は再帰呼び出しをせずにスタックで辿ってマージする。
+    競合した場合は dictb の値で上書きする
+
+    >>> dicta = {'a': 1, 'b': {'x': 10, 'z': 30}}
+    >>> merge_into(dicta, {'b': {'x': 10, 'y': {'p': 1}}, 'c': 4})
+    >>> dicta
+    {'a': 1, 'b': {'x': 10, 'z': 30, 'y': {'p': 1}}, 'c': 4}
+    """
+    stack = [(dicta, dictb)]
+    while stack:
+        dst, src = stack.pop()
+        for key, value in src.items():
+            if key in dst:
+                dst_value = dst[key]
+                if isinstance(dst_value, dict) and isinstance(value, dict):
+                    stack.append((dst_value, value))
+                elif dst_value == value:
+                    pass  # same leaf value
+                else:
+                    # conflict and override original value with new one
+                    dst[key] = value
+            else:
+                dst[key] = value
+
+
 def merge_dicts(dicta, dictb, path=None):
     """merge two dicts.
 
-    Merge dicta and dictb, then create new dict.
+    Merge dictb into dicta, then return dicta.
     When conflicts, override dicta as dictb.
 
     >>> dicta = {'a': 1, 'b': 2}
@@ -680,22 +1166,7 @@ def merge_dicts(dicta, dictb, path=None):
     {'a': 1, 'b': {'x': 10, 'z': 30, 'y': 20}, 'c': 4}
 
     """
-    if path is None:
-        path = []
-    for key in dictb:
-        if key in dicta:
-            if isinstance(dicta[key], dict) and isinstance(dictb[key], dict):
-                merge_dicts(dicta[key], dictb[key], path + [str(key)])
-            elif dicta[key] == dictb[key]:
-                pass  # same leaf value
-            # elif str(dicta[key]) in str(dictb[key]):
-            #    # strで上書き。JSONだったのをstrに変換したデータ
-            #    dicta[key] = dictb[key]
-            else:
-                # conflict and override original value with new one
-                dicta[key] = dictb[key]
-        else:
-            dicta[key] = dictb[key]
+    merge_into(dicta, dictb)
     return dicta
 
 
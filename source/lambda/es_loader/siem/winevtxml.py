@@ -3,13 +3,13 @@
 import csv
 import os
 import re
-import xml
 from functools import lru_cache
 
-import xmltodict
+from siem import utils
 
 re_firstword = re.compile(r'<Event xmlns=')
 re_lastword = re.compile(r'</Event>$')
+control_chars = dict.fromkeys(range(32))
 
 with open(f'{os.path.dirname(__file__)}/winevtxml_eventid.tsv') as f:
     event_id_dict = {}
@@ -42,8 +42,9 @@ def initial_extract_action_outcome(logdata):
 
 def count_event(rawdata):
     count = 0
+    match_firstword = re_firstword.match
     for line in rawdata:
-        if re_firstword.match(line):
+        if match_firstword(line):
             count += 1
     return count
 
@@ -53,21 +54,26 @@ def extract_event(rawdata, start=0, end=0):
     metadata = {}
     multilog = []
     is_in_scope = False
+    match_firstword = re_firstword.match
+    search_lastword = re_lastword.search
     for line in rawdata:
-        first_match = re_firstword.match(line)
+        first_match = match_firstword(line)
         if first_match:
             count += 1
-            if not start < count <= end:
+            if count > end:
+                # no need to read the rest of file
+                return
+            elif count <= start:
                 continue
 
-        last_match = re_lastword.search(line)
+        last_match = search_lastword(line)
         if first_match and last_match:
             # it means one line. not multiline
             yield(line, metadata)
         elif first_match:
             multilog.append(line)
             is_in_scope = True
-        elif last_match:
+        elif last_match and is_in_scope:
             multilog.append(line)
             yield("".join(multilog), metadata)
             is_in_scope = False
@@ -77,7 +83,7 @@ def extract_event(rawdata, start=0, end=0):
 
 
 def parse(logdata):
-    logdata_dict = xmltodict.parse(
+    logdata_dict = utils.parse_xml(
         logdata,
         strip_whitespace=None,
         attr_prefix='',
@@ -91,9 +97,9 @@ def to_dict(logdata):
     logdata = logdata.strip().rstrip("\u0000")
     try:
         logdata_dict = parse(logdata)
-    except xml.parsers.expat.ExpatError:
+    except utils.XML_PARSE_ERRORS:
         # delete control character
-        logdata = logdata.translate(dict.fromkeys(range(32)))
+        logdata = logdata.translate(control_chars)
         logdata_dict = parse(logdata)
 
     logdata_dict['Event'].pop('#text', None)